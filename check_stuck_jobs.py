@@ -19,10 +19,10 @@
 from __future__ import print_function
 import os
 from os import path
-import redis
 from optparse import OptionParser
 from datetime import datetime, timedelta
 from dispatcher.models import Job
+from dispatcher.storage import get_storage
 from pprint import pprint
 
 version = "%prog 0.0.2"
@@ -42,7 +42,7 @@ def main():
                       help="Prettify the output")
     (options, args) = parser.parse_args()
 
-    redis_store = redis.Redis.from_url(options.queue)
+    redis_store = get_storage(options.queue)
 
     running_jobs = redis_store.lrange("jobs:running", 0, -1)
 
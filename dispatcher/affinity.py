@@ -0,0 +1,237 @@
+# This file is part of antiSMASH.
+#
+# antiSMASH is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# antiSMASH is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with antiSMASH.  If not, see <http://www.gnu.org/licenses/>.
+"""Give each job a dedicated set of cpus
+
+The cpu topology is read from /sys/devices/system. Cpus are claimed by
+holding an flock() on one lock file per cpu in a directory shared by all
+dispatchers on the machine, so claims are released automatically even if a
+dispatcher dies. Jobs are confined by starting them through numactl or
+taskset, which all child processes inherit. Memory is only preferred from
+the claimed node, unless strict binding is asked for, so jobs needing more
+memory than one node has spill over instead of being OOM-killed.
+"""
+from distutils.spawn import find_executable
+import errno
+import fcntl
+import glob
+import logging
+import os
+from os import path
+import re
+
+SYSFS_NODES = '/sys/devices/system/node'
+SYSFS_CPUS = '/sys/devices/system/cpu'
+
+
+def parse_cpulist(cpulist):
+    '''Parse a kernel cpu list like "0-3,8,10-11" into a list of ints'''
+    cpus = []
+    for part in cpulist.strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            start, end = part.split('-')
+            cpus.extend(range(int(start), int(end) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def format_cpulist(cpus):
+    '''Format a list of cpus in the kernel's cpu list format'''
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ','.join(str(start) if start == end else '{}-{}'.format(start, end) for start, end in ranges)
+
+
+def _read(filename):
+    with open(filename, 'r') as handle:
+        return handle.read().strip()
+
+
+def get_allowed_cpus():
+    '''Get the cpus this process may run on'''
+    try:
+        with open('/proc/self/status', 'r') as handle:
+            for line in handle:
+                if line.startswith('Cpus_allowed_list:'):
+                    return set(parse_cpulist(line.split(':', 1)[1]))
+    except IOError:
+        pass
+    return set(parse_cpulist(_read(path.join(SYSFS_CPUS, 'online'))))
+
+
+def get_core_id(cpu):
+    '''Get a sortable id of the physical core a cpu belongs to'''
+    topology = path.join(SYSFS_CPUS, 'cpu{}'.format(cpu), 'topology')
+    try:
+        return (int(_read(path.join(topology, 'physical_package_id'))),
+                int(_read(path.join(topology, 'core_id'))))
+    except (IOError, ValueError):
+        return (0, cpu)
+
+
+def get_topology():
+    '''Get a dict of NUMA node -> cpus of that node usable by this process
+
+    Hyperthread siblings are next to each other in the cpu lists, so taking
+    cpus from the front of a list fills up whole physical cores first.
+    '''
+    allowed = get_allowed_cpus()
+    nodes = {}
+    for node_dir in glob.glob(path.join(SYSFS_NODES, 'node[0-9]*')):
+        node = int(re.sub(r'\D', '', path.basename(node_dir)))
+        try:
+            cpus = set(parse_cpulist(_read(path.join(node_dir, 'cpulist'))))
+        except IOError:
+            continue
+        cpus &= allowed
+        if cpus:
+            nodes[node] = cpus
+    if not nodes:
+        # no NUMA support in the kernel, treat the machine as a single node
+        nodes[0] = allowed
+
+    return dict((node, sorted(cpus, key=lambda cpu: (get_core_id(cpu), cpu)))
+                for node, cpus in nodes.items())
+
+
+class CpuClaim(object):
+    '''A set of cpus claimed for one job'''
+    def __init__(self, cpus, nodes, handles, strict_memory=False):
+        self.cpus = sorted(cpus)
+        self.nodes = sorted(nodes)
+        self.strict_memory = strict_memory
+        self._handles = handles
+
+    @property
+    def cpulist(self):
+        return format_cpulist(self.cpus)
+
+    @property
+    def nodelist(self):
+        return format_cpulist(self.nodes)
+
+    def wrap_command(self, args):
+        '''Prefix a command line so the process and all its children stay on the claimed cpus'''
+        numactl = find_executable('numactl')
+        if numactl is not None and len(self.nodes) == 1:
+            if self.strict_memory:
+                memory = '--membind={}'.format(self.nodelist)
+            else:
+                memory = '--preferred={}'.format(self.nodelist)
+            return [numactl, '--physcpubind={}'.format(self.cpulist), memory] + list(args)
+        taskset = find_executable('taskset')
+        if taskset is not None:
+            return [taskset, '-c', self.cpulist] + list(args)
+        logging.warning("Neither numactl nor taskset found, not pinning cpus")
+        return list(args)
+
+    def get_env(self):
+        '''Environment variables for container run scripts, in docker --cpuset-* format
+
+        --cpuset-mems is a strict binding, so AS_CPUSET_MEMS is only set for
+        claims with strict_memory.
+        '''
+        env = {
+            'AS_CPUSET_CPUS': self.cpulist,
+        }
+        if self.strict_memory:
+            env['AS_CPUSET_MEMS'] = self.nodelist
+        return env
+
+    def release(self):
+        '''Give the cpus back'''
+        for handle in self._handles:
+            handle.close()
+        self._handles = []
+
+    def __repr__(self):
+        return '<CpuClaim cpus %s, nodes %s>' % (self.cpulist, self.nodelist)
+
+
+def _try_lock(lockdir, cpu):
+    '''Try to lock a cpu, return the open lock file or None'''
+    handle = open(path.join(lockdir, 'cpu{}'.format(cpu)), 'a')
+    try:
+        fcntl.flock(handle.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError as err:
+        handle.close()
+        if err.errno in (errno.EAGAIN, errno.EACCES):
+            return None
+        raise
+    return handle
+
+
+def claim_cpus(count, lockdir, topology=None, strict_memory=False):
+    '''Claim count cpus, staying within one NUMA node if possible
+
+    With strict_memory, jobs may only allocate memory from the claimed nodes.
+    Returns a CpuClaim, or None if not enough cpus are free.
+    '''
+    if topology is None:
+        topology = get_topology()
+    if not path.isdir(lockdir):
+        try:
+            os.makedirs(lockdir)
+        except OSError:
+            if not path.isdir(lockdir):
+                raise
+
+    claimed = {}
+    handles = []
+    free = {}
+    # only one claim at a time, so concurrent claims don't see each other's
+    # temporarily locked cpus as taken
+    with open(path.join(lockdir, 'claim.lock'), 'a') as claim_lock:
+        fcntl.flock(claim_lock.fileno(), fcntl.LOCK_EX)
+        try:
+            # lock every cpu we can get, then give back the ones we don't need
+            for node, cpus in topology.items():
+                for cpu in cpus:
+                    handle = _try_lock(lockdir, cpu)
+                    if handle is not None:
+                        free.setdefault(node, []).append((cpu, handle))
+
+            # fit the job into the fullest node that still has room, to keep
+            # bigger blocks free for later jobs; otherwise spill over nodes
+            fitting = [node for node, cpus in free.items() if len(cpus) >= count]
+            if fitting:
+                order = sorted(fitting, key=lambda node: (len(free[node]), node))[:1]
+            else:
+                order = sorted(free, key=lambda node: (-len(free[node]), node))
+
+            for node in order:
+                for cpu, handle in free[node]:
+                    if len(handles) >= count:
+                        break
+                    claimed[cpu] = node
+                    handles.append(handle)
+        finally:
+            for cpus in free.values():
+                for _, handle in cpus:
+                    if handle not in handles:
+                        handle.close()
+
+    if len(handles) < count:
+        for handle in handles:
+            handle.close()
+        return None
+
+    return CpuClaim(claimed.keys(), set(claimed.values()), handles, strict_memory)
@@ -0,0 +1,145 @@
+# This file is part of antiSMASH.
+#
+# antiSMASH is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# antiSMASH is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with antiSMASH.  If not, see <http://www.gnu.org/licenses/>.
+"""Pack finished job directories into compressed archives and restore them
+
+Archives are gzip compressed tar files stored next to the job directory. If
+pigz is installed, it is used to compress on several cores, otherwise the
+tarfile module is used. Both produce the same format.
+"""
+from distutils.spawn import find_executable
+import os
+from os import path
+from shutil import rmtree
+import subprocess
+import tarfile
+
+ARCHIVE_SUFFIX = '.tar.gz'
+
+
+class ArchiveError(RuntimeError):
+    '''Thrown if creating or reading an archive fails'''
+    pass
+
+
+def get_archive_name(jobdir):
+    '''Get the archive file name for a job directory'''
+    return jobdir.rstrip(os.sep) + ARCHIVE_SUFFIX
+
+
+def get_dir_size(dirname):
+    '''Get the size of all files in a directory, in bytes'''
+    total = 0
+    for root, _, files in os.walk(dirname):
+        for filename in files:
+            try:
+                total += os.lstat(path.join(root, filename)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def archive_jobdir(jobdir, threads=0):
+    '''Pack a job directory into an archive and remove the directory
+
+    Returns a tuple of (archive name, original size, archive size).
+    '''
+    jobdir = jobdir.rstrip(os.sep)
+    archive_name = get_archive_name(jobdir)
+    tmp_name = archive_name + '.tmp'
+    original_size = get_dir_size(jobdir)
+
+    try:
+        pigz = find_executable('pigz')
+        if pigz is not None:
+            _pack_with_pigz(pigz, jobdir, tmp_name, threads)
+        else:
+            _pack_with_tarfile(jobdir, tmp_name)
+        os.rename(tmp_name, archive_name)
+    except (OSError, IOError, tarfile.TarError, ArchiveError) as err:
+        if path.exists(tmp_name):
+            os.remove(tmp_name)
+        raise ArchiveError("Failed to archive {}: {}".format(jobdir, err))
+
+    rmtree(jobdir, ignore_errors=True)
+    return archive_name, original_size, os.stat(archive_name).st_size
+
+
+def _pack_with_pigz(pigz, jobdir, archive_name, threads):
+    '''Stream tar output through pigz'''
+    pigz_args = [pigz, '-c']
+    if threads > 0:
+        pigz_args += ['-p', str(threads)]
+
+    with open(archive_name, 'wb') as handle:
+        tar = subprocess.Popen(['tar', '-C', path.dirname(jobdir), '-cf', '-', path.basename(jobdir)],
+                               stdout=subprocess.PIPE)
+        compressor = subprocess.Popen(pigz_args, stdin=tar.stdout, stdout=handle)
+        # let tar get a SIGPIPE if pigz dies
+        tar.stdout.close()
+        compressor.wait()
+        tar.wait()
+
+    if tar.returncode != 0 or compressor.returncode != 0:
+        raise ArchiveError("tar exited with {}, pigz exited with {}".format(tar.returncode, compressor.returncode))
+
+
+def _pack_with_tarfile(jobdir, archive_name):
+    '''Fallback if pigz isn't available'''
+    with tarfile.open(archive_name, 'w:gz') as archive:
+        archive.add(jobdir, arcname=path.basename(jobdir))
+
+
+def restore_files(archive_name, target_dir, filenames=None):
+    '''Extract files from a job archive into target_dir
+
+    filenames are relative to the job directory. Only the requested files are
+    written, and reading stops as soon as all of them were found. Without
+    filenames, everything is extracted. Requesting a directory extracts all
+    files below it. Returns the list of extracted names.
+    '''
+    wanted = None
+    if filenames:
+        wanted = set(path.normpath(name) for name in filenames)
+
+    extracted = []
+    found = set()
+    wanted_dirs = set()
+    try:
+        with tarfile.open(archive_name, 'r|gz') as archive:
+            for member in archive:
+                # strip the leading <uid>/ directory
+                parts = path.normpath(member.name).split(os.sep, 1)
+                if len(parts) < 2 or parts[1].startswith('..') or path.isabs(parts[1]):
+                    continue
+                relname = parts[1]
+                if wanted is not None:
+                    if relname in wanted:
+                        found.add(relname)
+                        if member.isdir():
+                            wanted_dirs.add(relname + os.sep)
+                    elif not any(relname.startswith(dirname) for dirname in wanted_dirs):
+                        continue
+                member.name = relname
+                archive.extract(member, target_dir)
+                extracted.append(relname)
+                if wanted is not None and not wanted_dirs and found == wanted:
+                    break
+    except (OSError, IOError, tarfile.TarError) as err:
+        raise ArchiveError("Failed to read {}: {}".format(archive_name, err))
+
+    if wanted is not None and found != wanted:
+        raise ArchiveError("Not found in {}: {}".format(archive_name, ', '.join(sorted(wanted - found))))
+
+    return extracted
@@ -0,0 +1,169 @@
+# This file is part of antiSMASH.
+#
+# antiSMASH is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# antiSMASH is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with antiSMASH.  If not, see <http://www.gnu.org/licenses/>.
+'''Select jobs by filter and change their status in bulk'''
+from datetime import datetime
+
+# the job lists jobs in a given short status are kept in
+STATUS_LISTS = {
+    'pending': ('jobs:queued', 'jobs:timeconsuming'),
+    'running': ('jobs:running',),
+    'done': ('jobs:completed',),
+    'failed': ('jobs:completed',),
+}
+
+FILTER_FIELDS = ('status', 'dispatcher', 'email', 'jobtype', 'added')
+
+# Change the status of a batch of jobs and move them from one list to another.
+# Jobs are only touched if they are still in one of the allowed states, so jobs
+# changing state between selection and transition are left alone. Matching list
+# entries are overwritten with a marker and dropped with a single LREM, so each
+# batch only walks the source list once.
+#
+# KEYS: source list, target list, job:<uid> hashes...
+# ARGV: new status, LPUSH or RPUSH, comma-separated allowed short states,
+#       '1' to reset the filename of download jobs
+TRANSITION_SCRIPT = """
+local allowed = {}
+for state in string.gmatch(ARGV[3], '[^,]+') do
+    allowed[state] = true
+end
+
+local selected = {}
+local moved = {}
+for i = 3, #KEYS do
+    local key = KEYS[i]
+    local uid = string.sub(key, 5)
+    local status = redis.call('HGET', key, 'status')
+    if status and not selected[uid] and allowed[string.match(status, '^[^:]*')] then
+        selected[uid] = true
+        moved[#moved + 1] = uid
+        redis.call('HSET', key, 'status', ARGV[1])
+        if ARGV[4] == '1' then
+            local download = redis.call('HGET', key, 'download')
+            if download and download ~= '' then
+                redis.call('HSET', key, 'filename', '')
+            end
+        end
+    end
+end
+
+if #moved == 0 then
+    return moved
+end
+
+local marker = '__moved__'
+local entries = redis.call('LRANGE', KEYS[1], 0, -1)
+local found = false
+for idx, uid in ipairs(entries) do
+    if selected[uid] then
+        redis.call('LSET', KEYS[1], idx - 1, marker)
+        found = true
+    end
+end
+if found then
+    redis.call('LREM', KEYS[1], 0, marker)
+end
+
+for _, uid in ipairs(moved) do
+    redis.call(ARGV[2], KEYS[2], uid)
+end
+return moved
+"""
+
+
+def get_status_lists(status):
+    '''Get the job lists that jobs with the given short status are stored in'''
+    return STATUS_LISTS.get(status, ('jobs:{}'.format(status),))
+
+
+def parse_added(value):
+    '''Parse the "added" field of a job'''
+    # str() of a datetime leaves out the microseconds if they are 0
+    if '.' in value:
+        return datetime.strptime(value, "%Y-%m-%d %H:%M:%S.%f")
+    return datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+
+
+def job_matches(fields, filters):
+    '''Check if a job's fields match all given filters'''
+    status, dispatcher, email, jobtype, added = fields
+    if status is None:
+        return False
+    if filters.get('status') and status.split(':', 1)[0] not in filters['status']:
+        return False
+    if filters.get('dispatcher') and dispatcher not in filters['dispatcher']:
+        return False
+    if filters.get('email') and email not in filters['email']:
+        return False
+    if filters.get('jobtype') and jobtype not in filters['jobtype']:
+        return False
+    if filters.get('added_before') or filters.get('added_after'):
+        if not added:
+            return False
+        added = parse_added(added)
+        if filters.get('added_before') and added >= filters['added_before']:
+            return False
+        if filters.get('added_after') and added < filters['added_after']:
+            return False
+    return True
+
+
+def select_jobs(redis_store, statuses, filters, batch_size=1000):
+    '''Find the jobs matching the filters
+
+    Returns a dict mapping each job list to the matching uids in it.
+    Nothing is changed, so this also serves as a dry run.
+    '''
+    filters = dict(filters, status=statuses)
+    lists = []
+    for status in statuses:
+        for list_name in get_status_lists(status):
+            if list_name not in lists:
+                lists.append(list_name)
+
+    selected = {}
+    for list_name in lists:
+        matches = []
+        start = 0
+        while True:
+            uids = redis_store.lrange(list_name, start, start + batch_size - 1)
+            if not uids:
+                break
+            start += len(uids)
+            pipe = redis_store.pipeline(transaction=False)
+            for uid in uids:
+                pipe.hmget(u'job:{}'.format(uid), *FILTER_FIELDS)
+            for uid, fields in zip(uids, pipe.execute()):
+                if job_matches(fields, filters):
+                    matches.append(uid)
+        if matches:
+            selected[list_name] = matches
+    return selected
+
+
+def apply_transition(redis_store, selected, target, new_status, allowed,
+                     push='LPUSH', reset_download=False, batch_size=1000):
+    '''Atomically move the selected jobs to the target list, one batch per round trip
+
+    Returns the list of uids that were actually changed.
+    '''
+    transition = redis_store.register_script(TRANSITION_SCRIPT)
+    changed = []
+    for list_name, uids in sorted(selected.items()):
+        for i in range(0, len(uids), batch_size):
+            args = [new_status, push, ','.join(allowed), '1' if reset_download else '0']
+            keys = [list_name, target] + [u'job:{}'.format(uid) for uid in uids[i:i + batch_size]]
+            changed.extend(transition(keys=keys, args=args))
+    return changed
@@ -15,13 +15,30 @@
 '''smashctl job handling'''
 import argparse
 from collections import defaultdict
+import csv
+import errno
+import fcntl
+import glob
 import json
+from multiprocessing.pool import ThreadPool
 import os
 import sys
 import shutil
+import time
 from os import path
 from dispatcher.models import Job
 from dispatcher.mail import send_mail
+from dispatcher.ctl.bulk import select_jobs, apply_transition, get_status_lists
+from dispatcher.ctl.notice import parsedate
+from dispatcher.archive import restore_files, ArchiveError
+from dispatcher.layout import get_layout, get_jobdir, make_jobdir, DEFAULT_LAYOUT, LAYOUTS
+from redis import RedisError
+
+# files picked up when submitting all sequences in a directory
+SEQUENCE_EXTENSIONS = (
+    '.gbk', '.gb', '.gbff', '.genbank', '.embl', '.emb',
+    '.fasta', '.fa', '.fas', '.fna', '.faa', '.seq',
+)
 
 
 def setup_job_options(subparsers):
@@ -34,6 +51,9 @@ def setup_job_options(subparsers):
     p_job.add_argument('-w', '--workdir', dest="workdir",
                        help="Path to working directory that contains the uploaded sequences",
                        default="upload")
+    p_job.add_argument('--layout', dest="layout",
+                       choices=LAYOUTS.keys(), default=DEFAULT_LAYOUT,
+                       help="Directory layout of the working directory (default: %(default)s)")
     job_subparsers = p_job.add_subparsers(title='job-related commands')
 
     p_job_list = job_subparsers.add_parser('list',
@@ -84,8 +104,21 @@ def setup_job_options(subparsers):
     p_job_submit.add_argument('--gff3', dest='gff3',
                               default=argparse.SUPPRESS,
                               help="Feature annoations in GFF3 format")
-    p_job_submit.add_argument('sequence',
-                              help='Sequence file to run')
+    p_job_submit.add_argument('--threads', dest='threads',
+                              type=int, default=8,
+                              help="Number of input files to stage in parallel. Default: %(default)s")
+    p_job_submit.add_argument('--batch-size', dest='batch_size',
+                              type=int, default=1000,
+                              help="Number of jobs to register per database round trip. Default: %(default)s")
+    p_job_submit.add_argument('--copy', dest='copy',
+                              action='store_true', default=False,
+                              help="Always copy input files instead of hardlinking or reflinking them")
+    p_job_submit.add_argument('--mapping', dest='mapping',
+                              default=None,
+                              help="Write a tab-separated input to job id mapping to this file. Default: stdout")
+    p_job_submit.add_argument('sequence', nargs='+',
+                              help='Sequence file to run. Also accepts several files, directories, '
+                                   'glob patterns and CSV or JSONL manifests with per-job options')
     p_job_submit.set_defaults(func=job_submit)
 
     p_job_cancel = job_subparsers.add_parser('cancel',
@@ -105,19 +138,32 @@ def setup_job_options(subparsers):
     p_job_cancel.add_argument('--send-mail', dest="send_mail",
                               action='store_true', default=False,
                               help='Send a mail to the submitter if email address was provided')
-    p_job_cancel.add_argument('uid',
-                              help="Identifier of pending job to cancel")
+    p_job_cancel.add_argument('uid', nargs='?', default=None,
+                              help="Identifier of pending job to cancel. Leave out to cancel all jobs matching the filters")
+    add_filter_options(p_job_cancel, 'pending')
     p_job_cancel.set_defaults(func=job_cancel)
 
     p_job_restart = job_subparsers.add_parser('restart',
                                               help="Restart a job")
-    p_job_restart.add_argument('uid',
-                               help="Identifier of job to restart")
+    p_job_restart.add_argument('uid', nargs='?', default=None,
+                               help="Identifier of job to restart. Leave out to restart all jobs matching the filters")
     p_job_restart.add_argument('-l', '--long-running', dest="long_running",
                                action="store_true", default=False,
                                help="Put job into the long-running queue")
+    add_filter_options(p_job_restart, 'failed')
     p_job_restart.set_defaults(func=job_restart)
 
+    p_job_restore = job_subparsers.add_parser('restore',
+                                              help="Restore files of an archived job")
+    p_job_restore.add_argument('--target', dest='target',
+                               default=None,
+                               help="Directory to restore files to (default: the job directory)")
+    p_job_restore.add_argument('uid',
+                               help="Identifier of job to restore")
+    p_job_restore.add_argument('files', nargs='*',
+                               help="Files to restore, relative to the job directory (default: all)")
+    p_job_restore.set_defaults(func=job_restore)
+
     p_job_show = job_subparsers.add_parser('show',
                                            help="Show job details")
     p_job_show.add_argument('--pretty', dest='pretty', default='multiline',
@@ -129,6 +175,74 @@ def setup_job_options(subparsers):
     p_job_show.set_defaults(func=job_show)
 
 
+def add_filter_options(parser, default_status):
+    '''Options to select jobs for bulk operations'''
+    group = parser.add_argument_group('job filters')
+    group.add_argument('--with-status', dest='with_status', nargs='+', default=None,
+                       help="Only select jobs in these states (default: {})".format(default_status))
+    group.add_argument('--with-dispatcher', dest='with_dispatcher', nargs='+', default=None,
+                       help="Only select jobs run by these dispatchers")
+    group.add_argument('--with-email', dest='with_email', nargs='+', default=None,
+                       help="Only select jobs submitted with these email addresses")
+    group.add_argument('--with-jobtype', dest='with_jobtype', nargs='+', default=None,
+                       help="Only select jobs of these job types")
+    group.add_argument('--added-before', dest='added_before', type=parsedate, default=None,
+                       help="Only select jobs added before this time, in YYYY-MM-DD [HH:MM:SS] format")
+    group.add_argument('--added-after', dest='added_after', type=parsedate, default=None,
+                       help="Only select jobs added after this time, in YYYY-MM-DD [HH:MM:SS] format")
+    group.add_argument('--batch-size', dest='batch_size', type=int, default=1000,
+                       help="Number of jobs to handle per database round trip (default: %(default)s)")
+    group.add_argument('-n', '--dry-run', dest='dry_run', action='store_true', default=False,
+                       help="Only show the jobs that would be changed")
+    parser.set_defaults(default_status=default_status)
+
+
+def get_filters(args):
+    '''Collect the job filters given on the command line'''
+    filters = {
+        'dispatcher': args.with_dispatcher,
+        'email': args.with_email,
+        'jobtype': args.with_jobtype,
+        'added_before': args.added_before,
+        'added_after': args.added_after,
+    }
+    return dict((key, value) for key, value in filters.items() if value)
+
+
+def select_for_bulk(args, action, allowed):
+    '''Select the jobs for a bulk operation, print a summary and handle dry runs
+
+    Returns the selected jobs, or None if nothing should be changed.
+    '''
+    filters = get_filters(args)
+    if not filters and args.with_status is None:
+        print "Refusing to %s all %s jobs, give a job id or at least one filter" % (action, args.default_status)
+        sys.exit(1)
+
+    statuses = args.with_status or [args.default_status]
+    invalid = [status for status in statuses if status not in allowed]
+    if invalid:
+        print "Cannot %s jobs in status %s" % (action, ', '.join(invalid))
+        sys.exit(1)
+
+    selected = select_jobs(args.redis_store, statuses, filters, args.batch_size)
+    total = 0
+    for list_name, uids in sorted(selected.items()):
+        print "%s: %d matching jobs" % (list_name, len(uids))
+        total += len(uids)
+        if args.dry_run:
+            for uid in uids:
+                print "    %s" % uid
+
+    if args.dry_run:
+        print "Would %s %d jobs" % (action, total)
+        return None
+    if total == 0:
+        print "No matching jobs"
+        return None
+    return selected
+
+
 def job_list(args):
     '''Handle smashctl job list'''
     redis_store = args.redis_store
@@ -172,24 +286,179 @@ def job_list(args):
 def job_submit(args):
     '''Handle smashctl job submit'''
     redis_store = args.redis_store
-    opts = vars(args)
-    job = Job(**opts)
-    job.filename = path.basename(args.sequence)
+    try:
+        entries = collect_submissions(args.sequence)
+    except (IOError, ValueError, csv.Error) as err:
+        print "Failed to read submissions: %s" % err
+        sys.exit(1)
+    if not entries:
+        print "No sequence files found"
+        sys.exit(1)
+    if 'gff3' in args and len(entries) > 1:
+        print "--gff3 only works for a single sequence, use a manifest with a gff3 column instead"
+        sys.exit(1)
+
+    start = time.time()
+    layout = get_layout(args.layout)
+    pipe = redis_store.pipeline(transaction=False)
+    # indices into mapping of the jobs in the batch not sent yet
+    batch = []
+    mapping = []
+    pool = ThreadPool(max(args.threads, 1))
+    try:
+        staged = pool.imap(lambda entry: stage_job(args, layout, entry), entries)
+        for source, job, error in staged:
+            if job is None:
+                print >>sys.stderr, "Failed to stage %s: %s" % (source, error)
+                mapping.append((source, '', error))
+                continue
+            if len(entries) == 1:
+                print "Submitting job %r (%s)" % (job.uid, job.jobtype)
+            pipe.hmset("job:{}".format(job.uid), job.get_dict())
+            batch.append(len(mapping))
+            mapping.append((source, job.uid, 'submitted'))
+            if len(batch) >= args.batch_size:
+                enqueue_batch(pipe, [mapping[i][1] for i in batch])
+                batch = []
+        enqueue_batch(pipe, [mapping[i][1] for i in batch])
+        batch = []
+    except RedisError as err:
+        # keep the jobs queued so far in the mapping, and mark the rest
+        print >>sys.stderr, "Failed to queue jobs: %s" % err
+        for i in batch:
+            mapping[i] = (mapping[i][0], '', "failed to queue: %s" % err)
+        for entry in entries[len(mapping):]:
+            mapping.append((entry['sequence'], '', "not submitted"))
+    finally:
+        pool.close()
+        pool.join()
+
+    submitted = sum(1 for _, uid, _ in mapping if uid)
+    if len(entries) > 1 or args.mapping is not None:
+        write_mapping(args.mapping, mapping)
+        elapsed = time.time() - start
+        print >>sys.stderr, "Submitted %d of %d jobs in %.1f seconds (%.1f jobs/s)" % (
+            submitted, len(entries), elapsed, submitted / max(elapsed, 0.001))
+    if submitted < len(entries):
+        sys.exit(1)
+
+
+def collect_submissions(sources):
+    '''Turn files, directories, glob patterns and manifests into a list of per-job option dicts'''
+    entries = []
+    for source in sources:
+        if path.isdir(source):
+            for name in sorted(os.listdir(source)):
+                filename = path.join(source, name)
+                if name.startswith('.') or not name.lower().endswith(SEQUENCE_EXTENSIONS):
+                    continue
+                if path.isfile(filename):
+                    entries.append({'sequence': filename})
+        elif source.endswith('.csv') or source.endswith('.jsonl'):
+            entries.extend(read_manifest(source))
+        elif not path.exists(source) and glob.has_magic(source):
+            entries.extend({'sequence': filename} for filename in sorted(glob.glob(source)))
+        else:
+            entries.append({'sequence': source})
+    return entries
+
+
+def read_manifest(filename):
+    '''Read a CSV or JSONL manifest, one job per row with a "sequence" column and job options'''
+    basedir = path.dirname(path.abspath(filename))
+    with open(filename, 'rb') as handle:
+        if filename.endswith('.csv'):
+            rows = [dict((key, value) for key, value in row.items() if value != '')
+                    for row in csv.DictReader(handle)]
+        else:
+            rows = [json.loads(line) for line in handle if line.strip()]
+
+    entries = []
+    for row in rows:
+        entry = dict((str(key), value) for key, value in row.items())
+        if 'sequence' not in entry:
+            raise ValueError("Manifest {} has a row without a sequence: {!r}".format(filename, row))
+        # relative paths are relative to the manifest
+        for key in ('sequence', 'gff3'):
+            if key in entry:
+                entry[key] = path.join(basedir, entry[key])
+        entries.append(entry)
+    return entries
+
+
+def stage_job(args, layout, entry):
+    '''Create a job and its job directory for a submission entry
+
+    Returns (source, job, None), or (source, None, error) if the entry can't be staged.
+    '''
+    opts = dict(vars(args))
+    opts.update(entry)
+
+    jobdir = None
+    try:
+        job = Job(**opts)
+        job.filename = path.basename(entry['sequence'])
+        jobdir = make_jobdir(args.workdir, job.uid, layout)
+        stage_file(entry['sequence'], jobdir, args.copy)
+        if opts.get('gff3'):
+            stage_file(opts['gff3'], jobdir, args.copy)
+            job.gff3 = path.basename(opts['gff3'])
+    except Exception as err:
+        # anything from bad manifest options to unreadable files only fails this entry
+        if jobdir is not None:
+            shutil.rmtree(jobdir, ignore_errors=True)
+        return entry['sequence'], None, str(err)
+
+    return entry['sequence'], job, None
+
+
+# from linux/fs.h
+FICLONE = 0x40049409
+
+
+def stage_file(filename, jobdir, copy=False):
+    '''Get a file into a job directory, hardlinking or reflinking it if possible'''
+    target = path.join(jobdir, path.basename(filename))
+    if not copy:
+        try:
+            os.link(filename, target)
+            return
+        except OSError as err:
+            if err.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+        try:
+            with open(filename, 'rb') as src, open(target, 'wb') as dest:
+                fcntl.ioctl(dest.fileno(), FICLONE, src.fileno())
+            return
+        except (IOError, OSError):
+            # no reflink support, fall back to copying below
+            pass
+    shutil.copy(filename, target)
 
-    jobdir = path.abspath(path.join(args.workdir, job.uid))
-    os.mkdir(jobdir)
-    shutil.copy(args.sequence, jobdir)
-    if 'gff3' in args:
-        shutil.copy(args.gff3, jobdir)
-        job.gff3 = path.basename(args.gff3)
 
-    print "Submitting job %r (%s)" % (job.uid, job.jobtype)
-    redis_store.hmset("job:{}".format(job.uid), job.get_dict())
-    redis_store.lpush("jobs:queued", job.uid)
+def enqueue_batch(pipe, uids):
+    '''Queue a batch of jobs registered in pipe and send everything to the database'''
+    if uids:
+        pipe.lpush("jobs:queued", *uids)
+    pipe.execute()
+
+
+def write_mapping(filename, mapping):
+    '''Write a tab-separated input file to job id mapping'''
+    handle = sys.stdout if filename is None else open(filename, 'w')
+    try:
+        for source, uid, status in mapping:
+            handle.write("%s\t%s\t%s\n" % (source, uid, status))
+    finally:
+        if handle is not sys.stdout:
+            handle.close()
 
 
 def job_cancel(args):
     '''Handle smashctl job cancel'''
+    if args.uid is None:
+        return job_cancel_bulk(args)
+
     redis_store = args.redis_store
     job_id = "job:{}".format(args.uid)
     if not redis_store.exists(job_id):
@@ -202,7 +471,7 @@ def job_cancel(args):
         sys.exit(1)
 
     if args.delete and job.status == 'pending':
-        jobdir = path.abspath(path.join(args.workdir, job.uid))
+        jobdir = path.abspath(get_jobdir(args.workdir, job.uid, get_layout(args.layout)))
         try:
             shutil.rmtree(jobdir, False)
             print "Deleted job %r files." % job.uid
@@ -225,8 +494,46 @@ def job_cancel(args):
     print "Canceled job %r (%s)" % (job.uid, job.status)
 
 
+def job_cancel_bulk(args):
+    '''Handle smashctl job cancel with filters instead of a job id'''
+    redis_store = args.redis_store
+    allowed = ('pending', 'canceled')
+    if args.force:
+        allowed += ('running', 'done', 'failed')
+    selected = select_for_bulk(args, 'cancel', allowed)
+    if selected is None:
+        return
+
+    status = "%s: %s" % (args.status, args.reason)
+    statuses = args.with_status or [args.default_status]
+    changed = apply_transition(redis_store, selected, "jobs:%s" % args.status, status, statuses,
+                               push='LPUSH', batch_size=args.batch_size)
+    print "Canceled %d of %d matching jobs (%s)" % (len(changed), sum(map(len, selected.values())), status)
+
+    pending = set()
+    for list_name in get_status_lists('pending'):
+        pending.update(selected.get(list_name, []))
+    layout = get_layout(args.layout)
+    for uid in changed:
+        if args.delete and uid in pending:
+            jobdir = path.abspath(get_jobdir(args.workdir, uid, layout))
+            try:
+                shutil.rmtree(jobdir, False)
+            except OSError as err:
+                print "Failed to delete job %r files: %s" % (uid, err)
+        if args.send_mail:
+            job = Job(**redis_store.hgetall("job:{}".format(uid)))
+            try:
+                send_mail(job)
+            except Exception as err:
+                print "failed to send mail: %s" % err
+
+
 def job_restart(args):
     '''handle smashctl job restart'''
+    if args.uid is None:
+        return job_restart_bulk(args)
+
     redis_store = args.redis_store
     job_id = "job:{}".format(args.uid)
     if not redis_store.exists(job_id):
@@ -256,6 +563,49 @@ def job_restart(args):
     print "restarted job %r" % job.uid
 
 
+def job_restart_bulk(args):
+    '''Handle smashctl job restart with filters instead of a job id'''
+    selected = select_for_bulk(args, 'restart', ('running', 'canceled', 'done', 'failed', 'pending'))
+    if selected is None:
+        return
+
+    if args.long_running:
+        queue = "jobs:timeconsuming"
+    else:
+        queue = "jobs:queued"
+
+    statuses = args.with_status or [args.default_status]
+    changed = apply_transition(args.redis_store, selected, queue, "pending", statuses,
+                               push='RPUSH', reset_download=True, batch_size=args.batch_size)
+    print "Restarted %d of %d matching jobs" % (len(changed), sum(map(len, selected.values())))
+
+
+def job_restore(args):
+    '''Handle smashctl job restore'''
+    redis_store = args.redis_store
+    job_id = "job:{}".format(args.uid)
+    if not redis_store.exists(job_id):
+        print "No such job: {}".format(args.uid)
+        sys.exit(1)
+
+    job = Job(**redis_store.hgetall(job_id))
+    if not job.archive:
+        print "Job %r was not archived (%s)" % (job.uid, job.status)
+        sys.exit(1)
+
+    target = args.target
+    if target is None:
+        target = get_jobdir(args.workdir, job.uid, get_layout(args.layout))
+
+    try:
+        restored = restore_files(path.join(args.workdir, job.archive), target, args.files)
+    except ArchiveError as err:
+        print "Failed to restore job %r: %s" % (job.uid, err)
+        sys.exit(1)
+
+    print "Restored %d files of job %r to %s" % (len(restored), job.uid, target)
+
+
 def job_show(args):
     '''Handle smashctl job show'''
     redis_store = args.redis_store
@@ -277,6 +627,8 @@ def job_show(args):
     Filename: %(filename)s
     GFF3 file: %(gff3)s
     Download: %(download)s
+    Records: %(records)s
+    Bases: %(bases)s
     Added: %(added)s
     Last changed: %(last_changed)s
     Dispatcher: %(dispatcher)s
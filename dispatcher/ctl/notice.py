@@ -13,7 +13,6 @@
 # You should have received a copy of the GNU General Public License
 # along with antiSMASH.  If not, see <http://www.gnu.org/licenses/>.
 import argparse
-import redis
 from dispatcher.models import Notice
 from datetime import datetime, timedelta
 
@@ -68,7 +67,7 @@ def setup_notice_options(subparsers):
 
 
 def notice_list(args):
-    redis_store = redis.Redis.from_url(args.queue)
+    redis_store = args.redis_store
     notice_ids = redis_store.keys("notice:*")
     for notice_id in notice_ids:
         notice = redis_store.hgetall(notice_id)
@@ -81,13 +80,13 @@ def notice_list(args):
 
 
 def notice_add(args):
-    redis_store = redis.Redis.from_url(args.queue)
+    redis_store = args.redis_store
     notice = Notice(args.teaser, args.text, None, args.show_from,
                     args.show_until, args.category)
     redis_store.hmset("notice:{}".format(notice.id), notice.json)
 
 def notice_remove(args):
-    redis_store = redis.Redis.from_url(args.queue)
+    redis_store = args.redis_store
     if args.id == "all":
         notice_ids = redis_store.keys("notice:*")
     else:
@@ -0,0 +1,152 @@
+# This file is part of antiSMASH.
+#
+# antiSMASH is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# antiSMASH is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with antiSMASH.  If not, see <http://www.gnu.org/licenses/>.
+'''smashctl stats handling'''
+from datetime import datetime
+
+from dispatcher.ctl.notice import parsedate
+from dispatcher.stats import (
+    PERIODS,
+    HISTOGRAMS,
+    get_period_labels,
+    get_stats,
+    summarise_counts,
+    summarise_histogram,
+    convert_legacy_stats,
+    get_stage_stats,
+    get_percentile,
+    get_timeline_key,
+    parse_timeline,
+)
+
+
+def setup_stats_options(subparsers):
+    '''Shared setting for smashctl stats'''
+    p_stats = subparsers.add_parser('stats',
+                                    help="Show job statistics")
+    stats_subparsers = p_stats.add_subparsers(title='stats-related commands')
+
+    p_stats_show = stats_subparsers.add_parser('show',
+                                               help="Show job counts per period")
+    p_stats_show.add_argument('-p', '--period', dest='period',
+                              choices=PERIODS, default='week',
+                              help="Length of the periods to show (default: %(default)s)")
+    p_stats_show.add_argument('-l', '--last', dest='last',
+                              type=int, default=13,
+                              help="Number of periods to show, counting back from now (default: %(default)s)")
+    p_stats_show.add_argument('--by', dest='by',
+                              choices=['status', 'jobtype', 'dispatcher'], default='status',
+                              help="Split the counts by this (default: %(default)s)")
+    p_stats_show.add_argument('--histogram', dest='histogram',
+                              choices=HISTOGRAMS, default=None,
+                              help="Show a histogram of queue wait or run times over all shown periods instead")
+    p_stats_show.set_defaults(func=stats_show)
+
+    p_stats_convert = stats_subparsers.add_parser('convert',
+            help="Build statistics counters from the old jobs:<timestamp> hashes")
+    p_stats_convert.add_argument('--until', dest='until',
+                                 type=parsedate, default=None,
+                                 help="Only convert periods that ended before this time, in YYYY-MM-DD format. "
+                                      "Set this to when the dispatchers started recording counters (default: now)")
+    p_stats_convert.add_argument('--prune', dest='prune',
+                                 action='store_true', default=False,
+                                 help="Delete the old hashes once converted")
+    p_stats_convert.set_defaults(func=stats_convert)
+
+    p_stats_stages = stats_subparsers.add_parser('stages',
+            help="Show which analysis stages take up the most wall time")
+    p_stats_stages.add_argument('-p', '--period', dest='period',
+                                choices=PERIODS, default='week',
+                                help="Length of the periods to sum up (default: %(default)s)")
+    p_stats_stages.add_argument('-l', '--last', dest='last',
+                                type=int, default=4,
+                                help="Number of periods to sum up, counting back from now (default: %(default)s)")
+    p_stats_stages.add_argument('--jobtype', dest='jobtype',
+                                default=None,
+                                help="Only show jobs of this jobtype")
+    p_stats_stages.add_argument('--options', dest='options',
+                                default=None,
+                                help="Only show jobs run with exactly these options, e.g. clusterblast+smcogs, "
+                                     "or 'split' to show every option combination separately")
+    p_stats_stages.add_argument('-n', '--top', dest='top',
+                                type=int, default=20,
+                                help="Number of stages to show (default: %(default)s)")
+    p_stats_stages.set_defaults(func=stats_stages)
+
+    p_stats_timeline = stats_subparsers.add_parser('timeline',
+            help="Show the time a job spent in each stage")
+    p_stats_timeline.add_argument('uid',
+                                  help="uid of the job")
+    p_stats_timeline.set_defaults(func=stats_timeline)
+
+
+def stats_show(args):
+    '''Handle smashctl stats show'''
+    labels = get_period_labels(args.period, args.last)
+    stats = get_stats(args.redis_store, args.period, labels)
+
+    if args.histogram is not None:
+        totals = {}
+        for _, counters in stats:
+            for bucket, count in summarise_histogram(counters, args.histogram):
+                totals[bucket] = totals.get(bucket, 0) + count
+        for bucket, _ in summarise_histogram({}, args.histogram):
+            print "<= %s s\t%s" % (bucket, totals[bucket])
+        return
+
+    rows = [(label, summarise_counts(counters, args.by)) for label, counters in stats]
+    columns = sorted(set(key for _, totals in rows for key in totals))
+    print "\t".join([args.period] + columns + ['total'])
+    for label, totals in rows:
+        values = [totals.get(column, 0) for column in columns]
+        print "\t".join([label] + [str(value) for value in values] + [str(sum(values))])
+
+
+def stats_convert(args):
+    '''Handle smashctl stats convert'''
+    converted, pruned = convert_legacy_stats(args.redis_store, args.until, args.prune)
+    print "Converted %d hashes, pruned %d" % (converted, pruned)
+
+
+def stats_stages(args):
+    '''Handle smashctl stats stages'''
+    labels = get_period_labels(args.period, args.last)
+    options = True if args.options == 'split' else args.options
+    stages = get_stage_stats(args.redis_store, args.period, labels, args.jobtype, options)
+    if not stages:
+        print "No stage timings recorded"
+        return
+
+    total = sum(entry['sum'] for entry in stages.values())
+    ranked = sorted(stages.items(), key=lambda item: item[1]['sum'], reverse=True)
+    print "\t".join(['share', 'hours', 'count', 'mean s', 'p50 s', 'p90 s', 'stage'])
+    for name, entry in ranked[:args.top]:
+        if options is True:
+            name = '[{}] {}'.format(*name)
+        print "%5.1f%%\t%.1f\t%d\t%.0f\t<=%s\t<=%s\t%s" % (
+            100.0 * entry['sum'] / max(total, 1), entry['sum'] / 3600.0, entry['count'],
+            float(entry['sum']) / max(entry['count'], 1),
+            get_percentile(entry['buckets'], 0.5), get_percentile(entry['buckets'], 0.9), name)
+
+
+def stats_timeline(args):
+    '''Handle smashctl stats timeline'''
+    timeline = parse_timeline(args.redis_store.lrange(get_timeline_key(args.uid), 0, -1))
+    if not timeline:
+        print "No timeline recorded for job %s" % args.uid
+        return
+    # the last entry is the final status for finished jobs, or the current stage
+    for (start, status), (stop, _) in zip(timeline, timeline[1:] + [(None, None)]):
+        started = datetime.utcfromtimestamp(start).strftime("%Y-%m-%d %H:%M:%S")
+        print "%s\t%s\t%s" % (started, '-' if stop is None else '%.0f s' % (stop - start), status)
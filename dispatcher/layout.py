@@ -0,0 +1,154 @@
+# This file is part of antiSMASH.
+#
+# antiSMASH is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# antiSMASH is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with antiSMASH.  If not, see <http://www.gnu.org/licenses/>.
+"""Map job uids to job directories in the working directory
+
+The flat layout keeps all job directories in the working directory itself,
+the sharded layout spreads them over two levels of hashed prefix directories,
+e.g. <workdir>/3f/a0/<uid>. Lookups fall back to the other layouts, so a
+working directory can be migrated while dispatchers keep running.
+"""
+import hashlib
+import os
+from os import path
+
+
+class LayoutError(ValueError):
+    '''Thrown for unknown directory layouts'''
+    pass
+
+
+class FlatLayout(object):
+    '''All job directories directly in the working directory'''
+    name = 'flat'
+
+    def relpath(self, uid):
+        '''Get the path of a job directory relative to the working directory'''
+        return uid
+
+    def iter_jobdirs(self, workdir):
+        '''Iterate over all job directories in this layout'''
+        for name in os.listdir(workdir):
+            if _looks_like_uid(name):
+                dirname = path.join(workdir, name)
+                if path.isdir(dirname):
+                    yield dirname
+
+
+class ShardedLayout(object):
+    '''Job directories in hashed prefix directories'''
+    name = 'sharded'
+
+    def __init__(self, levels=2, width=2):
+        self.levels = levels
+        self.width = width
+
+    def relpath(self, uid):
+        '''Get the path of a job directory relative to the working directory'''
+        digest = hashlib.md5(uid.encode('utf-8')).hexdigest()
+        shards = [digest[i * self.width:(i + 1) * self.width] for i in range(self.levels)]
+        return path.join(*(shards + [uid]))
+
+    def iter_jobdirs(self, workdir):
+        '''Iterate over all job directories in this layout'''
+        for dirname in self._iter_shards(workdir, self.levels):
+            for name in os.listdir(dirname):
+                if _looks_like_uid(name):
+                    jobdir = path.join(dirname, name)
+                    # archives of sharded jobs live next to the job directories
+                    if path.isdir(jobdir):
+                        yield jobdir
+
+    def _iter_shards(self, dirname, levels):
+        if levels == 0:
+            yield dirname
+            return
+        for name in os.listdir(dirname):
+            if len(name) != self.width or _looks_like_uid(name):
+                continue
+            subdir = path.join(dirname, name)
+            if not path.isdir(subdir):
+                continue
+            for shard in self._iter_shards(subdir, levels - 1):
+                yield shard
+
+
+LAYOUTS = {
+    'flat': FlatLayout,
+    'sharded': ShardedLayout,
+}
+
+DEFAULT_LAYOUT = os.getenv('AS_WORKDIR_LAYOUT', 'flat')
+
+
+def _looks_like_uid(name):
+    '''Job uids are <taxon>-<uuid4>, matching the old *-*-* glob
+
+    Names with a suffix, like <uid>.tar.gz archives, are not job directories.
+    '''
+    return name.count('-') >= 2 and '.' not in name
+
+
+def get_layout(name):
+    '''Get a layout object by name'''
+    try:
+        return LAYOUTS[name]()
+    except KeyError:
+        raise LayoutError('Unknown workdir layout {!r}'.format(name))
+
+
+def get_jobdir(workdir, uid, layout):
+    '''Get the directory of a job
+
+    Existing directories are found in any layout, new directories are placed
+    according to the given layout.
+    '''
+    wanted = path.join(workdir, layout.relpath(uid))
+    if path.isdir(wanted):
+        return wanted
+    for other in LAYOUTS.values():
+        if isinstance(layout, other):
+            continue
+        candidate = path.join(workdir, other().relpath(uid))
+        if path.isdir(candidate):
+            return candidate
+    return wanted
+
+
+def make_parent_dir(dirname):
+    '''Create any missing shard directories above a job directory'''
+    parent = path.dirname(dirname)
+    if path.isdir(parent):
+        return
+    try:
+        os.makedirs(parent)
+    except OSError:
+        # another process might have created the shard in the meantime
+        if not path.isdir(parent):
+            raise
+
+
+def make_jobdir(workdir, uid, layout):
+    '''Create a new job directory, including any missing shard directories'''
+    jobdir = path.abspath(path.join(workdir, layout.relpath(uid)))
+    make_parent_dir(jobdir)
+    os.mkdir(jobdir)
+    return jobdir
+
+
+def iter_jobdirs(workdir):
+    '''Iterate over the job directories of all layouts'''
+    for layout_class in LAYOUTS.values():
+        for dirname in layout_class().iter_jobdirs(workdir):
+            yield dirname
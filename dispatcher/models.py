@@ -79,6 +79,9 @@ class Job(object):
         self.min_domain_number = kwargs.get('min_domain_number', None)
         self.gff3 = kwargs.get('gff3', None)
         self.transatpks_da = get_bool(kwargs, 'transatpks_da', False)
+        self.records = int(kwargs.get('records', 0))
+        self.bases = int(kwargs.get('bases', 0))
+        self.archive = kwargs.get('archive', '')
 
     def get_short_status(self):
         """Get a short status description useful for icon names"""
@@ -0,0 +1,359 @@
+# This file is part of antiSMASH.
+#
+# antiSMASH is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# antiSMASH is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with antiSMASH.  If not, see <http://www.gnu.org/licenses/>.
+"""Per-period job statistics counters
+
+For every day, week and month there is one small hash stats:<period>:<label>
+with the fields
+    count:<jobtype>:<status>:<dispatcher>   number of finished jobs
+    wait:<jobtype>:<bucket>                 histogram of queue wait times
+    run:<jobtype>:<bucket>                  histogram of run times
+    wait_sum:<jobtype>, run_sum:<jobtype>   total seconds, for averages
+where <bucket> is the upper bound of a histogram bucket in seconds, or 'inf'.
+The size of these hashes doesn't grow with the number of jobs, so querying
+a range of periods costs one HGETALL per period.
+
+Every status change of a job is also appended to the list timeline:<uid> as
+"<unix time>\t<status>". When the job finishes, the time spent in each
+analysis stage is added to stage:<period>:<label> hashes with the fields
+    <jobtype>|<options>|<stage>|<bucket>    histogram of stage durations
+    <jobtype>|<options>|<stage>|sum         total seconds spent in the stage
+where <options> lists the enabled analysis options, e.g. clusterblast+smcogs.
+"""
+from datetime import datetime, timedelta
+import re
+import time
+
+PERIODS = ('day', 'week', 'month')
+
+# same labels as the old jobs:<timestamp> hashes
+PERIOD_FORMATS = {
+    'day': "%Y-%m-%d",
+    'week': "%Y-CW%U",
+    'month': "%Y-%m",
+}
+
+# upper bounds of the histogram buckets, in seconds
+HISTOGRAM_BUCKETS = (10, 30, 60, 300, 600, 1800, 3600, 7200, 14400, 28800, 86400)
+HISTOGRAMS = ('wait', 'run')
+
+# the old per-period hashes mapping every job uid to its status
+LEGACY_PATTERNS = (
+    ('day', re.compile(r'^jobs:(\d{4}-\d{2}-\d{2})$')),
+    ('week', re.compile(r'^jobs:(\d{4}-CW\d{2})$')),
+    ('month', re.compile(r'^jobs:(\d{4}-\d{2})$')),
+)
+CONVERTED_KEY = 'stats:converted'
+
+# keep job timelines around as long as cleanup_jobs keeps successful jobs
+TIMELINE_TTL = 4 * 7 * 24 * 60 * 60
+
+# job options that change which analysis stages run, or how long they take
+STAGE_OPTIONS = (
+    'all_orfs', 'asf', 'borderpredict', 'cassis', 'clusterblast', 'coexpress', 'fullhmmer',
+    'inclusive', 'knownclusterblast', 'smcogs', 'subclusterblast', 'transatpks_da', 'tta',
+)
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+def get_stats_key(period, label):
+    '''Get the key of the statistics hash for a period'''
+    return 'stats:{}:{}'.format(period, label)
+
+
+def get_labels(when):
+    '''Get the (period, label) tuples a point in time is counted towards'''
+    return [(period, when.strftime(PERIOD_FORMATS[period])) for period in PERIODS]
+
+
+def get_bucket(seconds):
+    '''Get the histogram bucket for a duration'''
+    for bound in HISTOGRAM_BUCKETS:
+        if seconds <= bound:
+            return str(bound)
+    return 'inf'
+
+
+def record_job(pipe, job, started, finished):
+    '''Add the counter updates for a finished job to a pipeline'''
+    status = job.get_short_status()
+    wait = max(0, int((started - job.added).total_seconds()))
+    runtime = max(0, int((finished - started).total_seconds()))
+    for period, label in get_labels(finished):
+        key = get_stats_key(period, label)
+        pipe.hincrby(key, 'count:{}:{}:{}'.format(job.jobtype, status, job.dispatcher), 1)
+        pipe.hincrby(key, 'wait:{}:{}'.format(job.jobtype, get_bucket(wait)), 1)
+        pipe.hincrby(key, 'run:{}:{}'.format(job.jobtype, get_bucket(runtime)), 1)
+        pipe.hincrby(key, 'wait_sum:{}'.format(job.jobtype), wait)
+        pipe.hincrby(key, 'run_sum:{}'.format(job.jobtype), runtime)
+
+
+def get_period_labels(period, count, until=None):
+    '''Get the labels of the last count periods, oldest first'''
+    if until is None:
+        until = datetime.utcnow()
+    labels = []
+    if period == 'month':
+        year, month = until.year, until.month
+        for _ in range(count):
+            labels.append('{:04d}-{:02d}'.format(year, month))
+            month -= 1
+            if month == 0:
+                year, month = year - 1, 12
+    elif period == 'week':
+        day = until.date()
+        for _ in range(count):
+            labels.append(day.strftime(PERIOD_FORMATS[period]))
+            # %U weeks start on Sunday, and are cut short at the turn of the
+            # year, so week 00 and the last week of the year before can be
+            # just a few days long
+            start = max(day - timedelta(days=(day.weekday() + 1) % 7), day.replace(month=1, day=1))
+            day = start - timedelta(days=1)
+    else:
+        for i in range(count):
+            labels.append((until - timedelta(days=i)).strftime(PERIOD_FORMATS[period]))
+    return labels[::-1]
+
+
+def get_stats(redis_store, period, labels):
+    '''Fetch the statistics hashes for the given periods in one round trip
+
+    Returns a list of (label, {field: count}) tuples.
+    '''
+    pipe = redis_store.pipeline(transaction=False)
+    for label in labels:
+        pipe.hgetall(get_stats_key(period, label))
+    return [(label, dict((field, int(value)) for field, value in counters.items()))
+            for label, counters in zip(labels, pipe.execute())]
+
+
+def summarise_counts(counters, by):
+    '''Sum up count:<jobtype>:<status>:<dispatcher> fields by one of the three'''
+    index = ('jobtype', 'status', 'dispatcher').index(by)
+    totals = {}
+    for field, value in counters.items():
+        if not field.startswith('count:'):
+            continue
+        parts = field.split(':', 3)[1:]
+        if len(parts) != 3:
+            continue
+        totals[parts[index]] = totals.get(parts[index], 0) + value
+    return totals
+
+
+def summarise_histogram(counters, name):
+    '''Sum up the histogram buckets of all job types, in bucket order'''
+    totals = {}
+    prefix = name + ':'
+    for field, value in counters.items():
+        if not field.startswith(prefix):
+            continue
+        bucket = field.rsplit(':', 1)[1]
+        totals[bucket] = totals.get(bucket, 0) + value
+    order = [str(bound) for bound in HISTOGRAM_BUCKETS] + ['inf']
+    return [(key, totals.get(key, 0)) for key in order]
+
+
+def parse_legacy_key(key):
+    '''Get (period, label) for an old jobs:<timestamp> hash, or None for other keys'''
+    for period, pattern in LEGACY_PATTERNS:
+        match = pattern.match(key)
+        if match:
+            return period, match.group(1)
+    return None
+
+
+def convert_legacy_stats(redis_store, until=None, prune=False, batch_size=1000):
+    '''Build counters from the old jobs:<timestamp> hashes
+
+    Only periods that ended before until are converted, which defaults to now.
+    Set it to the time the dispatchers started recording counters to avoid
+    counting jobs twice. Converted hashes are remembered in stats:converted,
+    so running this again doesn't count them twice either. With prune,
+    converted hashes are deleted. Returns the number of hashes converted and
+    pruned.
+    '''
+    if until is None:
+        until = datetime.utcnow()
+    current = dict(get_labels(until))
+    converted = 0
+    pruned = 0
+    for key in redis_store.scan_iter('jobs:[0-9]*'):
+        parsed = parse_legacy_key(key)
+        if parsed is None:
+            continue
+        period, label = parsed
+        # labels sort chronologically within a period type
+        if label >= current[period]:
+            continue
+        if not redis_store.sismember(CONVERTED_KEY, key):
+            counts = count_legacy_hash(redis_store, key, batch_size)
+            stats_key = get_stats_key(*parsed)
+            pipe = redis_store.pipeline()
+            for field, value in counts.items():
+                pipe.hincrby(stats_key, field, value)
+            pipe.sadd(CONVERTED_KEY, key)
+            pipe.execute()
+            converted += 1
+        if prune:
+            redis_store.delete(key)
+            pruned += 1
+    return converted, pruned
+
+
+def count_legacy_hash(redis_store, key, batch_size=1000):
+    '''Count the jobs in an old jobs:<timestamp> hash by job type, status and dispatcher'''
+    counts = {}
+    batch = []
+
+    def count_batch():
+        pipe = redis_store.pipeline(transaction=False)
+        for uid, _ in batch:
+            pipe.hmget(u'job:{}'.format(uid), 'jobtype', 'dispatcher')
+        for (uid, status), (jobtype, dispatcher) in zip(batch, pipe.execute()):
+            field = 'count:{}:{}:{}'.format(jobtype or 'unknown', status, dispatcher or 'unknown')
+            counts[field] = counts.get(field, 0) + 1
+
+    for uid, status in redis_store.hscan_iter(key, count=batch_size):
+        batch.append((uid, status))
+        if len(batch) >= batch_size:
+            count_batch()
+            batch = []
+    if batch:
+        count_batch()
+    return counts
+
+
+def get_timeline_key(uid):
+    '''Get the key of a job's status timeline'''
+    return u'timeline:{}'.format(uid)
+
+
+def record_status(pipe, uid, status, when=None):
+    '''Append a status change to a job's timeline'''
+    pipe.rpush(get_timeline_key(uid), format_timeline_entry(status, when))
+
+
+def format_timeline_entry(status, when=None):
+    '''Format a status change as a timeline entry'''
+    if when is None:
+        timestamp = time.time()
+    else:
+        timestamp = (when - _EPOCH).total_seconds()
+    return '{:.1f}\t{}'.format(timestamp, status)
+
+
+def parse_timeline(entries):
+    '''Parse timeline entries into a list of (unix time, status) tuples'''
+    timeline = []
+    for entry in entries:
+        timestamp, _, status = entry.partition('\t')
+        try:
+            timeline.append((float(timestamp), status))
+        except ValueError:
+            continue
+    return timeline
+
+
+def get_stage_name(status):
+    '''Turn a status line into a stage name, e.g. "running: Running clusterblast" -> "Running clusterblast"'''
+    short, _, detail = status.partition(':')
+    stage = detail.strip() or short.strip()
+    # drop record numbers and the like, so they all count towards the same stage
+    stage = re.sub(r'\d+', '#', stage)
+    return stage.replace('|', '/')[:80]
+
+
+def get_option_signature(job):
+    '''Get a compact description of the analysis options enabled for a job'''
+    enabled = [option for option in STAGE_OPTIONS if getattr(job, option, False) is True]
+    return '+'.join(enabled) or 'default'
+
+
+def get_stage_durations(timeline, finished):
+    '''Get (stage, seconds) tuples from a parsed timeline, the last stage ending at finished
+
+    Consecutive entries of the same stage are merged into one.
+    '''
+    end = (finished - _EPOCH).total_seconds()
+    durations = []
+    for (start, status), (stop, _) in zip(timeline, timeline[1:] + [(end, None)]):
+        stage = get_stage_name(status)
+        seconds = max(0, stop - start)
+        if durations and durations[-1][0] == stage:
+            durations[-1] = (stage, durations[-1][1] + seconds)
+        else:
+            durations.append((stage, seconds))
+    return durations
+
+
+def record_stages(pipe, job, entries, finished):
+    '''Add the stage duration updates for a finished job to a pipeline'''
+    prefix = '{}|{}'.format(job.jobtype, get_option_signature(job))
+    durations = get_stage_durations(parse_timeline(entries), finished)
+    for period, label in get_labels(finished):
+        key = get_stage_key(period, label)
+        for stage, seconds in durations:
+            pipe.hincrby(key, '{}|{}|{}'.format(prefix, stage, get_bucket(seconds)), 1)
+            pipe.hincrby(key, '{}|{}|sum'.format(prefix, stage), int(round(seconds)))
+
+
+def get_stage_key(period, label):
+    '''Get the key of the stage duration hash for a period'''
+    return 'stage:{}:{}'.format(period, label)
+
+
+def get_stage_stats(redis_store, period, labels, jobtype=None, options=None):
+    '''Sum up stage durations over several periods
+
+    Returns a dict of stage -> {'count': n, 'sum': seconds, 'buckets': {bucket: n}}
+    where stage is (options, stage name) if options is True, the stage name
+    otherwise. With a string for options, only jobs with exactly these options
+    are counted.
+    '''
+    pipe = redis_store.pipeline(transaction=False)
+    for label in labels:
+        pipe.hgetall(get_stage_key(period, label))
+
+    stages = {}
+    for counters in pipe.execute():
+        for field, value in counters.items():
+            parts = field.split('|')
+            if len(parts) != 4:
+                continue
+            field_jobtype, field_options, stage, bucket = parts
+            if jobtype is not None and field_jobtype != jobtype:
+                continue
+            if options not in (None, True) and field_options != options:
+                continue
+            name = (field_options, stage) if options is True else stage
+            entry = stages.setdefault(name, {'count': 0, 'sum': 0, 'buckets': {}})
+            if bucket == 'sum':
+                entry['sum'] += int(value)
+            else:
+                entry['count'] += int(value)
+                entry['buckets'][bucket] = entry['buckets'].get(bucket, 0) + int(value)
+    return stages
+
+
+def get_percentile(buckets, fraction):
+    '''Get the histogram bucket a percentile falls into'''
+    total = sum(buckets.values())
+    seen = 0
+    for bucket in [str(bound) for bound in HISTOGRAM_BUCKETS] + ['inf']:
+        seen += buckets.get(bucket, 0)
+        if total and seen >= fraction * total:
+            return bucket
+    return 'inf'
@@ -1,9 +1,77 @@
 # This file is part of antiSMASH and distributed under the same license
-'''Unify storage access for all scripts'''
+'''Unify storage access for all scripts
 
+Storage URIs can be redis://host:port/db, unix:///path/to/socket?db=0 or
+sentinel://host:port[,host:port...]/service. Connections are pooled per
+process, and commands failing because the server went away are retried with
+a jittered exponential backoff, giving sentinel time to promote a new master.
+Master re-discovery happens automatically whenever a new connection is opened.
+
+Only failures that guarantee the command didn't run are retried for every
+command: not being able to connect, and the server refusing the command while
+loading or being a replica. A command that was sent but got no reply might
+have run already, so it is only retried if running it twice is harmless.
+'''
+
+import logging
+import os
+import random
+import time
 from urlparse import urlparse
 import redis
 from redis.sentinel import Sentinel
+from redis.exceptions import ConnectionError, TimeoutError, BusyLoadingError, RedisError
+
+try:
+    from redis.exceptions import ReadOnlyError
+except ImportError:
+    # older redis-py versions report writes to a demoted master as a plain
+    # ResponseError, which isn't safe to retry
+    class ReadOnlyError(RedisError):
+        '''Never raised, stands in for the missing exception'''
+        pass
+
+DEFAULT_TIMEOUT = float(os.getenv('AS_REDIS_TIMEOUT', 5))
+DEFAULT_CONNECT_TIMEOUT = float(os.getenv('AS_REDIS_CONNECT_TIMEOUT', 2))
+SENTINEL_TIMEOUT = float(os.getenv('AS_SENTINEL_TIMEOUT', 0.5))
+HEALTH_CHECK_INTERVAL = int(os.getenv('AS_REDIS_HEALTH_CHECK_INTERVAL', 30))
+
+RETRY_ERRORS = (ConnectionError, TimeoutError, BusyLoadingError, ReadOnlyError)
+
+# commands that are harmless to run twice, so they can be retried even if the
+# first attempt might have reached the server
+IDEMPOTENT_COMMANDS = frozenset([
+    'AUTH', 'DEL', 'EXISTS', 'EXPIRE', 'GET', 'HDEL', 'HEXISTS', 'HGET', 'HGETALL', 'HKEYS',
+    'HLEN', 'HMGET', 'HMSET', 'HSCAN', 'HSET', 'HVALS', 'INFO', 'KEYS', 'LINDEX', 'LLEN',
+    'LRANGE', 'LSET', 'MGET', 'PING', 'SADD', 'SCAN', 'SCARD', 'SCRIPT', 'SELECT', 'SET',
+    'SISMEMBER', 'SMEMBERS', 'SREM', 'SSCAN', 'TTL', 'TYPE',
+])
+
+
+class ConnectError(ConnectionError):
+    '''Thrown if no connection could be opened, so no command was sent'''
+    pass
+
+
+def _mark_connect_errors(connection_class):
+    '''Make a connection class raise ConnectError if it fails to connect'''
+    class MarkingConnection(connection_class):
+        def connect(self):
+            try:
+                return super(MarkingConnection, self).connect()
+            except ConnectError:
+                raise
+            except (ConnectionError, TimeoutError) as err:
+                raise ConnectError(*err.args)
+    MarkingConnection.__name__ = connection_class.__name__
+    return MarkingConnection
+
+
+def is_safe_to_retry(err, command):
+    '''Check if a command failing with err can be sent again'''
+    if isinstance(err, (ConnectError, BusyLoadingError, ReadOnlyError)):
+        return True
+    return command.split(' ', 1)[0].upper() in IDEMPOTENT_COMMANDS
 
 
 class AntismashStorageError(RuntimeError):
@@ -11,22 +79,117 @@ class AntismashStorageError(RuntimeError):
     pass
 
 
-def get_storage(queue, timeout=0.1):
-    '''Open a storage connection given a redis or sentinel URI'''
-    if queue.startswith('redis://'):
-        redis_store = redis.Redis.from_url(queue)
-    elif queue.startswith('sentinel://'):
-        parsed_url = urlparse(queue)
-        service = parsed_url.path.lstrip('/')
+class RetryPolicy(object):
+    '''Retry calls failing with connection errors, using full-jitter exponential backoff
+
+    Calls are retried until deadline seconds have passed since the first
+    failure, long enough by default to ride out a sentinel failover with the
+    default down-after-milliseconds of 30 seconds.
+    '''
+    def __init__(self, deadline=None, base_delay=0.2, max_delay=10.0):
+        if deadline is None:
+            deadline = float(os.getenv('AS_REDIS_RETRY_SECONDS', 90))
+        self.deadline = deadline
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def get_delay(self, attempt):
+        '''Get the time to wait before retrying after the given failed attempt'''
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def call(self, func, *args, **kwargs):
+        '''Call func, retrying on connection errors
+
+        If given, retry_if(err) decides whether an error is retried.
+        '''
+        retry_if = kwargs.pop('retry_if', None)
+        attempt = 0
+        give_up = None
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except RETRY_ERRORS as err:
+                if retry_if is not None and not retry_if(err):
+                    raise
+                now = time.time()
+                if give_up is None:
+                    give_up = now + self.deadline
+                remaining = give_up - now
+                if remaining <= 0:
+                    raise
+                attempt += 1
+                delay = min(self.get_delay(attempt), remaining)
+                logging.warning("Storage error: %s, retrying in %.1f seconds (%.0f seconds left)",
+                                err, delay, remaining)
+                time.sleep(delay)
+
+
+class RetryingRedis(redis.Redis):
+    '''Redis client that retries commands according to a RetryPolicy
+
+    Pipelines are not retried as a whole, as that could run some of their
+    commands twice; redis-py itself retries them once on connection errors.
+    '''
+    retry_policy = RetryPolicy()
+
+    def execute_command(self, *args, **options):
+        command = str(args[0])
+        return self.retry_policy.call(super(RetryingRedis, self).execute_command, *args,
+                                      retry_if=lambda err: is_safe_to_retry(err, command), **options)
+
+
+# storage clients by (queue, timeout), so all users in a process share a connection pool
+_STORES = {}
+
+
+def _get_pool_options(timeout):
+    '''Get the connection pool options supported by the installed redis-py'''
+    opts = {
+        'socket_timeout': timeout,
+        'socket_connect_timeout': DEFAULT_CONNECT_TIMEOUT,
+        'socket_keepalive': True,
+    }
+    if tuple(int(part) for part in redis.__version__.split('.')[:2]) >= (3, 3):
+        opts['health_check_interval'] = HEALTH_CHECK_INTERVAL
+    return opts
+
+
+def _parse_sentinel_hosts(netloc):
+    '''Parse host:port[,host:port...] into a list of (host, port) tuples'''
+    hosts = []
+    for entry in netloc.split(','):
         port = 26379
-        if ':' in parsed_url.netloc:
-            host, str_port = parsed_url.netloc.split(':')
+        if ':' in entry:
+            host, str_port = entry.split(':')
             port = int(str_port)
         else:
-            host = parsed_url.netloc
-        sentinel = Sentinel([(host, port)], socket_timeout=timeout)
-        redis_store = sentinel.master_for(service, redis_class=redis.Redis, socket_timeout=timeout)
+            host = entry
+        hosts.append((host, port))
+    return hosts
+
+
+def get_storage(queue, timeout=DEFAULT_TIMEOUT):
+    '''Open a storage connection given a redis, unix socket or sentinel URI'''
+    key = (queue, timeout)
+    if key in _STORES:
+        return _STORES[key]
+
+    opts = _get_pool_options(timeout)
+    if queue.startswith('redis://') or queue.startswith('unix://'):
+        if queue.startswith('unix://'):
+            # unix socket connections don't take TCP specific options
+            del opts['socket_keepalive']
+            del opts['socket_connect_timeout']
+        redis_store = RetryingRedis.from_url(queue, **opts)
+    elif queue.startswith('sentinel://'):
+        parsed_url = urlparse(queue)
+        service = parsed_url.path.lstrip('/')
+        sentinel = Sentinel(_parse_sentinel_hosts(parsed_url.netloc), socket_timeout=SENTINEL_TIMEOUT)
+        redis_store = sentinel.master_for(service, redis_class=RetryingRedis, **opts)
     else:
         raise AntismashStorageError('Unknown storage scheme {!r}'.format(queue))
 
+    pool = redis_store.connection_pool
+    pool.connection_class = _mark_connect_errors(pool.connection_class)
+    _STORES[key] = redis_store
     return redis_store
@@ -0,0 +1,233 @@
+# This file is part of antiSMASH.
+#
+# antiSMASH is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# antiSMASH is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with antiSMASH.  If not, see <http://www.gnu.org/licenses/>.
+"""Cheap pre-flight checks of job input files
+
+All checks stream over the input in fixed size chunks, so memory use does not
+depend on the size of the input file or the length of its lines.
+"""
+import logging
+import string
+
+CHUNK_SIZE = 64 * 1024
+
+NUCLEOTIDES = set('ACGTUN')
+IUPAC_NUCLEOTIDES = set('ACGTUNRYKMSWBDHV')
+
+# only look at this many sequence letters to guess the molecule type
+SNIFF_LETTERS = 100000
+
+# formats for which the record ids collected here are known to cover the ids
+# the antiSMASH parsers use, for the others mismatching GFF3 ids are only logged
+STRICT_ID_FORMATS = ('genbank', 'fasta')
+
+# the antiSMASH input parsers skip these in sequence lines
+_SEQUENCE_JUNK = string.digits + string.whitespace + '-.*/'
+
+
+class ValidationError(Exception):
+    '''Thrown if an input file is unsuitable for a job'''
+    pass
+
+
+class InputSummary(object):
+    '''Information gathered while validating an input file'''
+    def __init__(self, fmt):
+        self.format = fmt
+        self.records = 0
+        self.bases = 0
+        self.record_ids = set()
+        self.letters = 0
+        self.nucleotide_letters = 0
+        self.iupac_letters = 0
+
+    def add_sequence(self, line):
+        '''Count the sequence letters in a (partial) sequence line'''
+        seq = line.translate(None, _SEQUENCE_JUNK).upper()
+        self.bases += len(seq)
+        if self.letters >= SNIFF_LETTERS:
+            return
+        seq = seq[:SNIFF_LETTERS - self.letters]
+        self.letters += len(seq)
+        self.nucleotide_letters += sum(seq.count(char) for char in NUCLEOTIDES)
+        self.iupac_letters += sum(seq.count(char) for char in IUPAC_NUCLEOTIDES)
+
+    def guess_molecule(self):
+        '''Guess if the sequences seen so far are nucleotide or protein sequences'''
+        if self.letters == 0:
+            return None
+        if self.nucleotide_letters >= 0.9 * self.letters:
+            return 'nucl'
+        if self.iupac_letters < 0.9 * self.letters:
+            return 'prot'
+        return None
+
+    def __repr__(self):
+        return '<InputSummary %s: %s records, %s bases>' % (self.format, self.records, self.bases)
+
+
+def iter_lines(handle, chunk_size=CHUNK_SIZE):
+    '''Iterate over (at_line_start, text) pieces of a file
+
+    Lines longer than chunk_size are returned in several pieces, only the first
+    of which has at_line_start set.
+    '''
+    at_line_start = True
+    while True:
+        piece = handle.readline(chunk_size)
+        if not piece:
+            return
+        yield at_line_start, piece
+        at_line_start = piece.endswith('\n')
+
+
+def sniff_format(filename):
+    '''Guess the format of an input file from its first non-blank line'''
+    with open(filename, 'rb') as handle:
+        for _, piece in iter_lines(handle):
+            line = piece.strip()
+            if not line:
+                continue
+            lowered = line.lower()
+            if line.startswith('LOCUS'):
+                return 'genbank'
+            if line.startswith('ID '):
+                return 'embl'
+            if line.startswith('>'):
+                return 'fasta'
+            if line.startswith('<') or '<html' in lowered:
+                raise ValidationError("Input file looks like an HTML page, not a sequence file")
+            raise ValidationError("Can't detect input file format, expected GenBank, EMBL or FASTA")
+    raise ValidationError("Input file is empty")
+
+
+def _scan_flatfile(filename, fmt, header_tag, sequence_tag, id_tags):
+    '''Scan a GenBank or EMBL file, shared by both formats'''
+    summary = InputSummary(fmt)
+    in_sequence = False
+    with open(filename, 'rb') as handle:
+        for at_line_start, piece in iter_lines(handle):
+            if in_sequence:
+                if at_line_start and piece.startswith('//'):
+                    in_sequence = False
+                    continue
+                summary.add_sequence(piece)
+                continue
+            if not at_line_start:
+                continue
+            if piece.startswith('//'):
+                continue
+            if piece.startswith(header_tag):
+                summary.records += 1
+            if piece.startswith(sequence_tag):
+                in_sequence = True
+                continue
+            for tag in id_tags:
+                if piece.startswith(tag):
+                    parts = piece[len(tag):].split()
+                    if parts:
+                        summary.record_ids.add(parts[0].rstrip(';'))
+                    # EMBL ID lines carry the sequence version: "ID   X56734; SV 1; linear; ..."
+                    if tag == 'ID ' and fmt == 'embl' and len(parts) > 2 and parts[1] == 'SV':
+                        summary.record_ids.add('{}.{}'.format(parts[0].rstrip(';'), parts[2].rstrip(';')))
+    return summary
+
+
+def scan_genbank(filename):
+    '''Count records and bases in a GenBank file'''
+    return _scan_flatfile(filename, 'genbank', 'LOCUS ', 'ORIGIN',
+                          ('LOCUS ', 'ACCESSION ', 'VERSION '))
+
+
+def scan_embl(filename):
+    '''Count records and bases in an EMBL file'''
+    return _scan_flatfile(filename, 'embl', 'ID ', 'SQ ', ('ID ', 'AC ', 'SV '))
+
+
+def scan_fasta(filename):
+    '''Count records and bases in a FASTA file'''
+    summary = InputSummary('fasta')
+    with open(filename, 'rb') as handle:
+        for at_line_start, piece in iter_lines(handle):
+            if at_line_start and piece.startswith('>'):
+                summary.records += 1
+                parts = piece[1:].split()
+                if parts:
+                    summary.record_ids.add(parts[0])
+                continue
+            if at_line_start and piece.startswith(';'):
+                continue
+            summary.add_sequence(piece)
+    return summary
+
+
+SCANNERS = {
+    'genbank': scan_genbank,
+    'embl': scan_embl,
+    'fasta': scan_fasta,
+}
+
+
+def check_gff3(filename, record_ids, strict=True):
+    '''Check that a GFF3 file annotates at least one of the given records
+
+    If not strict, mismatching ids are only logged.
+    '''
+    seen = set()
+    with open(filename, 'rb') as handle:
+        for at_line_start, piece in iter_lines(handle):
+            if not at_line_start or not piece.strip():
+                continue
+            if piece.startswith('##FASTA'):
+                break
+            if piece.startswith('#'):
+                continue
+            seqid = piece.split('\t', 1)[0].strip()
+            if seqid in record_ids:
+                return
+            if len(seen) < 3:
+                seen.add(seqid)
+
+    if not seen:
+        raise ValidationError("GFF3 file does not contain any features")
+    msg = "GFF3 sequence ids ({}) don't match any record id in the input file ({})".format(
+        ', '.join(sorted(seen)), ', '.join(sorted(record_ids)[:3]))
+    if strict:
+        raise ValidationError(msg)
+    logging.warning("%s: %s", filename, msg)
+
+
+def validate_input(filename, molecule, gff3=None):
+    '''Validate an input file and return an InputSummary
+
+    Raises ValidationError with a user-readable message if the file is unusable.
+    '''
+    fmt = sniff_format(filename)
+    summary = SCANNERS[fmt](filename)
+
+    if summary.records == 0:
+        raise ValidationError("No {} records found in input file".format(fmt))
+    if summary.bases == 0:
+        raise ValidationError("Input file does not contain any sequence data")
+
+    guessed = summary.guess_molecule()
+    if guessed is not None and guessed != molecule:
+        if molecule == 'nucl':
+            raise ValidationError("Input file seems to contain protein sequences, but a nucleotide input was selected")
+        raise ValidationError("Input file seems to contain nucleotide sequences, but a protein input was selected")
+
+    if gff3:
+        check_gff3(gff3, summary.record_ids, strict=fmt in STRICT_ID_FORMATS)
+
+    return summary